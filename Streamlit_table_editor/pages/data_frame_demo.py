@@ -8,7 +8,11 @@ import pandas as pd
 # Write directly to the app
 st.title(f"dataframe demo in SiS :balloon:")
 
-df = pd.read_csv('./data/batch_info_table.csv')
+@st.cache_data
+def load_batch_info():
+    return pd.read_csv('./data/batch_info_table.csv', engine='pyarrow', dtype_backend='pyarrow')
+
+df = load_batch_info()
 
 st.subheader('Dataframe view')
 st.dataframe(df)
@@ -1,7 +1,9 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 from snowflake.snowpark.context import get_active_session
-from snowflake.snowpark.functions import col, lit
+from snowflake.snowpark.functions import col, lit, when_matched
 from datetime import datetime
 
 # --- Streamlit Page Configuration ---
@@ -10,28 +12,48 @@ st.set_page_config(page_title="Batch Data Editor", layout="wide")
 # --- Configuration ---
 TABLE_NAME = "DEMO.DT_TUTORIAL.SYNTHETIC_BATCH_DATA"
 PK_COLUMN = "BATCH_ID"
+EDITOR_COLUMNS = [PK_COLUMN, 'BATCH_NAME', 'PROJECT', 'TIMESTAMP', 'PERSON']
 EDITOR_KEY = "batch_editor"
+INSERT_VALUES_MAX_ROWS = 5000 # Above this, additions go through a staged upload instead
+DELETE_CHUNK_SIZE = 8000 # Keeps each DELETE's IN-list well under Snowflake's limit
 
 # --- Snowflake Session ---
+@st.cache_resource
+def get_session():
+    """Returns the active Snowflake session, looked up once per app process."""
+    return get_active_session()
+
 try:
-    session = get_active_session()
-    st.success("❄️ Connected to Snowflake!")
+    session = get_session()
+    if 'greeted' not in st.session_state:
+        st.success("❄️ Connected to Snowflake!")
+        st.session_state.greeted = True
 except Exception:
     st.error("Could not get active Snowflake session. Ensure you are running this in Snowflake.")
     st.stop()
 
 # --- Helper Functions ---
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_data(_session, table_name, pk_column):
-    """Fetches data from Snowflake and converts to Pandas."""
+    """Fetches data from Snowflake and converts to Pandas.
+
+    Cached per table for the whole app; call ``get_data.clear()`` after writing.
+    """
     st.write(f"Fetching data from `{table_name}`...")
     try:
-        snow_df = _session.table(table_name).order_by(col(pk_column).asc()).limit(100)
+        # Project to the editor's columns so only those are read and transferred
+        snow_df = (
+            _session.table(table_name)
+            .select([col(c) for c in EDITOR_COLUMNS])
+            .order_by(col(pk_column).asc())
+            .limit(100)
+        )
         pdf = snow_df.to_pandas()
         if pdf.empty:
             st.warning(f"Table '{table_name}' appears to be empty.")
             # Define columns if empty based on your known schema
-            pdf = pd.DataFrame(columns=[PK_COLUMN, 'BATCH_NAME', 'PROJECT', 'TIMESTAMP', 'PERSON'])
+            pdf = pd.DataFrame(columns=EDITOR_COLUMNS)
         elif pk_column not in pdf.columns:
             st.error(f"PK '{pk_column}' not found. Please check config.")
             st.stop()
@@ -45,6 +67,37 @@ def get_data(_session, table_name, pk_column):
         st.error(f"Error fetching data: {e}")
         return pd.DataFrame().set_index(PK_COLUMN, drop=False)
 
+def added_rows_schema(df):
+    """Arrow schema for editor-added rows, whose timestamps arrive as strings."""
+    fields = []
+    for field in pa.Schema.from_pandas(df, preserve_index=False):
+        if pa.types.is_timestamp(field.type) or pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+def editor_key():
+    """Returns the data editor's current widget key."""
+    return f"{EDITOR_KEY}_{st.session_state.editor_instance_id}"
+
+def reset_editor():
+    """Discards pending edits by remounting the data editor under a new key."""
+    # Deleting the key alone leaves the edits on screen; only a new key remounts the grid
+    current_key = editor_key()
+    if current_key in st.session_state:
+        del st.session_state[current_key]
+    st.session_state.editor_instance_id += 1
+
+def set_original_data(df):
+    """Stores the editor's source frame and its Arrow form for read-only views."""
+    st.session_state.original_data = df
+    st.session_state.original_data_arrow = pa.Table.from_pandas(df, preserve_index=False)
+    st.session_state.added_rows_schema = added_rows_schema(df)
+
+def row_hashes(df, pk_column):
+    """Hashes each row's non-PK values, so retyped-but-unchanged rows can be skipped."""
+    return pd.util.hash_pandas_object(df.drop(columns=[pk_column]).infer_objects(), index=False)
+
 def get_changes_from_editor(editor_key, original_df, pk_column):
     """Extracts additions, edits, and deletions."""
     if editor_key not in st.session_state: return None
@@ -53,88 +106,123 @@ def get_changes_from_editor(editor_key, original_df, pk_column):
     edited_rows = changes.get("edited_rows", [])
     deleted_rows_indices = changes.get("deleted_rows", [])
 
-    added_df = pd.DataFrame(added_rows)
+    # Blank added rows arrive as {}; columns no added row filled are left to table DEFAULTs
+    added_df = pa.Table.from_pylist(
+        [row for row in added_rows if row], schema=st.session_state.added_rows_schema
+    ).to_pandas().dropna(axis=1, how='all')
     if 'TIMESTAMP' in added_df.columns:
         added_df['TIMESTAMP'] = pd.to_datetime(added_df['TIMESTAMP'], errors='coerce')
 
     changes_dict = {"added": added_df, "edited": {}, "deleted": pd.DataFrame()}
 
     if edited_rows:
-        edited_pks = [original_df.index[i] for i in edited_rows.keys()]
+        edited_pks = original_df.index.to_numpy()[list(edited_rows.keys())]
         original_edited = original_df.loc[edited_pks].copy()
-        new_edited = original_edited.copy()
-        for idx, changes_for_row in edited_rows.items():
-            pk_val = original_df.index[idx]
-            for col_name, new_val in changes_for_row.items():
-                new_edited.loc[pk_val, col_name] = new_val
-        if 'TIMESTAMP' in new_edited.columns:
+        # Patch of new values plus a mask of touched cells (a cell cleared to None is still an edit)
+        patch = pd.DataFrame.from_dict(edited_rows, orient='index')
+        touched = pd.DataFrame.from_dict(
+            {idx: dict.fromkeys(row, True) for idx, row in edited_rows.items()}, orient='index'
+        )
+        patch.index = touched.index = edited_pks
+        touched = touched.reindex_like(original_edited).notna()
+        new_edited = original_edited.mask(touched, patch)
+        # Only edited timestamps arrive as strings; untouched ones are already datetime64
+        if any('TIMESTAMP' in row for row in edited_rows.values()):
             new_edited['TIMESTAMP'] = pd.to_datetime(new_edited['TIMESTAMP'], errors='coerce')
-        changes_dict["edited"] = {"original": original_edited, "new": new_edited}
+        changed = row_hashes(new_edited, pk_column).to_numpy() != row_hashes(original_edited, pk_column).to_numpy()
+        if changed.any():
+            changes_dict["edited"] = {"original": original_edited[changed], "new": new_edited[changed]}
 
     if deleted_rows_indices:
-        deleted_pks = [original_df.index[i] for i in deleted_rows_indices]
+        deleted_pks = original_df.index.to_numpy()[deleted_rows_indices]
         changes_dict["deleted"] = original_df.loc[deleted_pks]
 
     return changes_dict
 
+def to_snowflake_values(df):
+    """Converts Timestamps to datetimes and NaN/NaT to None, column-wise."""
+    clean = df.copy()
+    for c in clean.select_dtypes(include=['datetime64[ns]']).columns:
+        clean[c] = pd.Series(clean[c].dt.to_pydatetime(), index=clean.index, dtype=object)
+    return clean.astype(object).where(clean.notna(), None)
+
 def apply_changes(_session, table_name, pk_column, changes):
-    """Applies changes to Snowflake table."""
+    """Applies changes to Snowflake table.
+
+    Statements are submitted without blocking and their results gathered at the
+    end. Snowflake still serialises the DELETEs and the MERGE on the table's
+    lock; only the INSERT can overlap with them.
+    """
     snow_table = _session.table(table_name)
     results = {"added": 0, "edited": 0, "deleted": 0, "errors": []}
+    jobs = [] # (results key, error label, AsyncJob, result -> row count)
     try:
         # Deletions
         if not changes["deleted"].empty:
-            deleted_ids = changes["deleted"][pk_column].tolist()
-            if deleted_ids:
-                delete_result = snow_table.delete(col(pk_column).in_(deleted_ids))
-                results["deleted"] = delete_result.rows_deleted
-        # Updates
+            deleted_ids = changes["deleted"].index.to_numpy().tolist() # Indexed by PK
+            for start in range(0, len(deleted_ids), DELETE_CHUNK_SIZE):
+                chunk = deleted_ids[start:start + DELETE_CHUNK_SIZE]
+                delete_job = snow_table.delete(col(pk_column).in_(chunk), block=False)
+                jobs.append(("deleted", "Delete", delete_job, lambda r: r.rows_deleted))
+        # Updates (staged once, then applied with a single MERGE)
         if changes["edited"]:
-            edited_df = changes["edited"]["new"]
-            for pk_id, row in edited_df.iterrows():
-                update_dict = row.drop(pk_column).to_dict() # Exclude PK
-                for k, v in update_dict.items():
-                    if pd.isna(v): update_dict[k] = None
-                    elif isinstance(v, pd.Timestamp): update_dict[k] = v.to_pydatetime()
-                try:
-                    update_result = snow_table.update(update_dict, col(pk_column) == pk_id)
-                    results["edited"] += update_result.rows_updated
-                except Exception as e: results["errors"].append(f"Update {pk_id}: {e}")
+            edited_df = to_snowflake_values(changes["edited"]["new"].reset_index(drop=True))
+            try:
+                source = _session.create_dataframe(edited_df)
+                update_cols = [c for c in edited_df.columns if c != pk_column]
+                merge_job = snow_table.merge(
+                    source,
+                    snow_table[pk_column] == source[pk_column],
+                    [when_matched().update({c: source[c] for c in update_cols})],
+                    block=False,
+                )
+                jobs.append(("edited", "Update", merge_job, lambda r: r.rows_updated))
+            except Exception as e: results["errors"].append(f"Update: {e}")
         # Additions
         if not changes["added"].empty:
             added_df_for_insert = changes["added"].drop(columns=[pk_column], errors='ignore')
+            added_count = len(added_df_for_insert)
             try:
-                snow_df_to_add = _session.create_dataframe(added_df_for_insert)
-                snow_df_to_add.write.mode("append").save_as_table(table_name)
-                results["added"] = len(added_df_for_insert)
+                if added_count <= INSERT_VALUES_MAX_ROWS:
+                    # One parameterised multi-row INSERT, no stage upload
+                    insert_values = to_snowflake_values(added_df_for_insert)
+                    row_params = "(" + ", ".join(["?"] * len(insert_values.columns)) + ")"
+                    insert_sql = (
+                        f"INSERT INTO {table_name} ({', '.join(insert_values.columns)}) "
+                        f"VALUES {', '.join([row_params] * len(insert_values))}"
+                    )
+                    params = [v for row in insert_values.itertuples(index=False, name=None) for v in row]
+                    insert_job = _session.sql(insert_sql, params=params).collect_nowait()
+                else:
+                    snow_df_to_add = _session.create_dataframe(added_df_for_insert)
+                    insert_job = snow_df_to_add.write.mode("append").save_as_table(table_name, block=False)
+                jobs.append(("added", "Add", insert_job, lambda r: added_count))
             except Exception as e: results["errors"].append(f"Add: {e}")
     except Exception as e: results["errors"].append(f"General: {e}")
+    # Wait on everything that was submitted, even if a later step failed
+    for key, label, job, row_count in jobs:
+        try: results[key] += row_count(job.result())
+        except Exception as e: results["errors"].append(f"{label}: {e}")
     return results
 
+def apply_changes_locally(df, changes):
+    """Returns a copy of df with confirmed deletions and edits applied in memory."""
+    df = df.drop(index=changes["deleted"].index, errors='ignore')
+    if changes["edited"]:
+        new_edited = changes["edited"]["new"]
+        new_edited = new_edited[new_edited.index.isin(df.index)]
+        df.loc[new_edited.index, new_edited.columns] = new_edited
+    return df
+
 # NEW: Function to create a styling DataFrame for highlighting changes
 def style_changed_cells(new_df, original_df):
     """Creates a Styler DF to highlight changes between two DataFrames."""
-    style_df = pd.DataFrame('', index=new_df.index, columns=new_df.columns)
-    # Ensure original_df is aligned and has same columns for comparison
-    original_comp = original_df.reindex(new_df.index)
-
-    for idx in new_df.index:
-        for col_name in new_df.columns:
-            new_val = new_df.loc[idx, col_name]
-            try:
-                original_val = original_comp.loc[idx, col_name]
-                # Compare considering NaT/NaN as equal
-                if (pd.isna(new_val) and pd.isna(original_val)):
-                    changed = False
-                else:
-                    changed = new_val != original_val
-                
-                if changed:
-                    style_df.loc[idx, col_name] = 'background-color: #ffff99' # Yellow highlight
-            except KeyError:
-                 # Should not happen if DFs are aligned, but handle defensively
-                 style_df.loc[idx, col_name] = 'background-color: #ffcccc' # Red if error
-    return style_df
+    aligned = original_df.reindex(index=new_df.index, columns=new_df.columns)
+    new_values, original_values = new_df.to_numpy(), aligned.to_numpy()
+    # Compare considering NaT/NaN as equal
+    changed = (new_values != original_values) & ~(pd.isna(new_values) & pd.isna(original_values))
+    style_df = np.where(changed, 'background-color: #ffff99', '') # Yellow highlight
+    return pd.DataFrame(style_df, index=new_df.index, columns=new_df.columns)
 
 # --- Streamlit App UI ---
 st.title("📊 Batch Data Editor & Confirmer")
@@ -143,23 +231,25 @@ st.sidebar.warning(f"`{PK_COLUMN}` is auto-generating & cannot be edited.")
 
 # --- Initialize Session State ---
 if 'original_data' not in st.session_state:
-    st.session_state.original_data = get_data(session, TABLE_NAME, PK_COLUMN)
+    set_original_data(get_data(session, TABLE_NAME, PK_COLUMN))
     st.session_state.show_confirmation = False
     st.session_state.changes_to_confirm = None
     st.session_state.editor_instance_id = 0
 
-# Ensure it exists even if 'original_data' does (for subsequent runs/older state)
+# Ensure these exist even if 'original_data' does (for subsequent runs/older state)
 if 'editor_instance_id' not in st.session_state:
     st.session_state.editor_instance_id = 0
+if 'added_rows_schema' not in st.session_state:
+    set_original_data(st.session_state.original_data)
 
 # --- Main Data Editor ---
 st.subheader("Edit Batch Data Here")
 st.caption("Edit/Add/Delete rows, then click 'Review Changes'.")
 
-current_key = f"{EDITOR_KEY}_{st.session_state.editor_instance_id}"
+current_key = editor_key()
 
 edited_df = st.data_editor(
-    st.session_state.original_data.copy(), 
+    st.session_state.original_data.copy(deep=False), # Edits live in session_state[current_key]
     key=current_key, 
     num_rows="dynamic",
     use_container_width=True, disabled=[PK_COLUMN],
@@ -169,7 +259,6 @@ edited_df = st.data_editor(
 )
 
 if st.button("Review Changes"):
-    current_key = f"{EDITOR_KEY}_{st.session_state.editor_instance_id}"
     st.session_state.changes_to_confirm = get_changes_from_editor(
         current_key, st.session_state.original_data, PK_COLUMN
     )
@@ -187,40 +276,43 @@ if st.session_state.get('show_confirmation', False) and st.session_state.changes
     changes = st.session_state.changes_to_confirm
     st.markdown("---")
     st.subheader("Please Confirm Your Changes")
-    has_changes = False
+    # One tab per kind of change present, so only one set of grids is on screen at a time
+    tab_names = []
+    if not changes["deleted"].empty: tab_names.append("Deleted")
+    if not changes["added"].empty: tab_names.append("Added")
+    if changes["edited"]: tab_names.append("Edited")
+    has_changes = bool(tab_names)
+    tabs = dict(zip(tab_names, st.tabs(tab_names))) if has_changes else {}
 
-    if not changes["deleted"].empty:
-        st.warning("Rows to be DELETED:")
-        st.dataframe(changes["deleted"], use_container_width=True)
-        has_changes = True
+    if "Deleted" in tabs:
+        with tabs["Deleted"]:
+            st.warning("Rows to be DELETED:")
+            st.dataframe(changes["deleted"], use_container_width=True)
 
-    if not changes["added"].empty:
-        st.info("Rows to be ADDED:")
-        st.dataframe(changes["added"], use_container_width=True)
-        has_changes = True
+    if "Added" in tabs:
+        with tabs["Added"]:
+            st.info("Rows to be ADDED:")
+            st.dataframe(changes["added"], use_container_width=True)
 
-    # --- MODIFIED: Show Edited Rows Separately ---
-    if changes["edited"]:
-        st.info("Rows to be EDITED:")
-        
-        # Box 1: Original State
-        st.markdown("##### Original State:")
-        st.dataframe(changes["edited"]["original"], use_container_width=True)
-
-        # Box 2: New State with Highlights
-        st.markdown("##### New State (Changes Highlighted):")
-        new_edited_df = changes["edited"]["new"]
-        original_edited_df = changes["edited"]["original"]
-        
-        # Apply the new styling function
-        styled_df = new_edited_df.style.apply(
-            lambda df: style_changed_cells(df, original_edited_df), 
-            axis=None
-        )
-        st.dataframe(styled_df, use_container_width=True)
-        
-        has_changes = True
-    # --- END MODIFICATION ---
+    if "Edited" in tabs:
+        with tabs["Edited"]:
+            st.info("Rows to be EDITED:")
+
+            # Box 1: Original State
+            st.markdown("##### Original State:")
+            st.dataframe(changes["edited"]["original"], use_container_width=True)
+
+            # Box 2: New State with Highlights
+            st.markdown("##### New State (Changes Highlighted):")
+            new_edited_df = changes["edited"]["new"]
+            original_edited_df = changes["edited"]["original"]
+
+            # Highlights are computed once per review and reused on later reruns
+            if "styles" not in changes["edited"]:
+                changes["edited"]["styles"] = style_changed_cells(new_edited_df, original_edited_df)
+            cell_styles = changes["edited"]["styles"]
+            styled_df = new_edited_df.style.apply(lambda df: cell_styles, axis=None)
+            st.dataframe(styled_df, use_container_width=True)
 
     if not has_changes:
          st.warning("Changes were not detected. Please review again.")
@@ -232,17 +324,20 @@ if st.session_state.get('show_confirmation', False) and st.session_state.changes
                     results = apply_changes(session, TABLE_NAME, PK_COLUMN, changes)
                     st.success("Changes applied!")
                     st.write(results)
-                    # Clear state and refresh
-                    st.session_state.original_data = get_data(session, TABLE_NAME, PK_COLUMN)
+                    # Clear state and refresh; the cache is shared by every session, so drop it
+                    get_data.clear()
+                    if results["errors"] or not changes["added"].empty:
+                        # Added rows get their PKs in Snowflake; reload to pick them up
+                        set_original_data(get_data(session, TABLE_NAME, PK_COLUMN))
+                    else:
+                        set_original_data(apply_changes_locally(
+                            st.session_state.original_data, changes
+                        ))
                     st.session_state.show_confirmation = False
                     st.session_state.changes_to_confirm = None
 
-                    # Clean up current key and increment
-                    current_key = f"{EDITOR_KEY}_{st.session_state.editor_instance_id}"
-                    if current_key in st.session_state: 
-                        del st.session_state[current_key]
-                    st.session_state.editor_instance_id += 1
-                    
+                    reset_editor()
+
                     st.balloons()
                     st.rerun()
         with col2:
@@ -252,16 +347,14 @@ if st.session_state.get('show_confirmation', False) and st.session_state.changes
                 st.session_state.show_confirmation = False
                 st.session_state.changes_to_confirm = None
                 
-                # Force new editor instance by changing key 
-                current_key = f"{EDITOR_KEY}_{st.session_state.editor_instance_id}"
-                if current_key in st.session_state:
-                    del st.session_state[current_key]
-                st.session_state.editor_instance_id += 1 # Increment ID for new key
+                reset_editor()
                 
                 st.rerun()
 
 # --- Expander for Raw Data ---
 st.markdown("---")
-expander = st.expander("See Current 100 Records from Database")
+# After a save without additions, this is the loaded rows with the saved changes applied
+# locally, so it can hold fewer than 100 rows until the next reload
+expander = st.expander("See Current Records (as loaded, with saved changes)")
 with expander:
-    st.dataframe(st.session_state.original_data, use_container_width=True)
\ No newline at end of file
+    st.dataframe(st.session_state.original_data_arrow, use_container_width=True)